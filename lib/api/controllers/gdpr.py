@@ -0,0 +1,98 @@
+from .base import BaseController
+
+
+class Controller(BaseController):
+    def __init__(self, database=None):
+        self.database = database
+
+    def _result_type(self, risk):
+        if risk == 'high':
+            return self.database.HighRiskResult
+        if risk == 'low':
+            return self.database.LowRiskResult
+        raise APIError('Unknown risk level', status_code=400, risk=risk)
+
+    def sensitive_documents_range(self, start, end):
+        """
+        The company's high and low risk results from start to end, ordered
+        by document id. Results are stored as JSON, so the rows are returned
+        as they are instead of being unpickled.
+        """
+        company_id = self.get_current_user().company.id
+
+        def data(result_type):
+            query = result_type.select(
+                lambda r: r.company.id == company_id
+            ).order_by(lambda r: r.document_id)
+            return [result.data for result in query[start:end]]
+
+        return {
+            'high_risk_documents': data(self.database.HighRiskResult),
+            'risk_documents': data(self.database.LowRiskResult)
+        }
+
+    def set_gdpr_documents_included(self, document_ids, included):
+        """
+        Sends the change of the documents' included field to the search
+        index. Must be called whenever documents are included in or
+        excluded from the GDPR search, e.g. when removed documents are
+        included again.
+        """
+        company_id = self.get_current_user().company.id
+        self.task_handler.revoke_and_send(
+            "set_documents_included",
+            track_ids=[],
+            kwargs={
+                "company_id": company_id,
+                "document_ids": list(document_ids),
+                "included": included
+            }
+        )
+
+    def sensitive_documents_page(self,
+                                 risk,
+                                 after=None,
+                                 limit=100,
+                                 descending=False,
+                                 relation=None,
+                                 keyword=None,
+                                 person=None):
+        """
+        A page of the company's GDPR results, filtered in the database and
+        paginated by document id. Pass the document id of the last result
+        as after to get the next page.
+        :return: a generator of (document id, result data) pairs, which
+        reads the results in its own session while the response streams
+        """
+        company_id = self.get_current_user().company.id
+        result_type = self._result_type(risk)
+
+        @self.database.session
+        def results():
+            query = self._page_query(result_type, company_id, after,
+                                     descending, relation, keyword, person)
+            for result in query.limit(limit):
+                yield result.document_id, result.data
+
+        return results()
+
+    @staticmethod
+    def _page_query(result_type, company_id, after, descending,
+                    relation, keyword, person):
+        query = result_type.select(lambda r: r.company.id == company_id)
+        if relation is not None:
+            query = query.filter(lambda r: relation in r.relations)
+        if keyword is not None:
+            query = query.filter(lambda r: keyword in r.keywords)
+        if person is not None:
+            query = query.filter(lambda r: person in r.names)
+
+        if descending:
+            if after is not None:
+                query = query.filter(lambda r: r.document_id < after)
+            query = query.order_by(lambda r: desc(r.document_id))
+        else:
+            if after is not None:
+                query = query.filter(lambda r: r.document_id > after)
+            query = query.order_by(lambda r: r.document_id)
+        return query
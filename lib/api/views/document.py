@@ -1,10 +1,22 @@
+import json
+
+from archii.api.exceptions import APIError
 from archii.api.permissions import PrivateEditDocumentPermission, authorize, \
     AssignGroupDocumentPermission
 from archii.api.schemas.document import (
     DocumentIndexSchema,
     SensitiveDocumentsIndexSchema
 )
-from .utils import success_response
+from .utils import success_response, streamed_response
+
+MAX_PAGE_SIZE = 500
+
+
+def _page_limit(limit):
+    # bool is an int, but never a page size
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+        raise APIError('Invalid page size', status_code=400, limit=limit)
+    return min(limit, MAX_PAGE_SIZE)
 
 
 def similarity_repr(sim_docs):
@@ -113,11 +125,50 @@ class View:
         return success_response(deleted_doc_count)
 
     def sensitive_documents_view(self, start, end):
-        result = self.controllers.sensitive_documents(start, end)
+        result = self.controllers.sensitive_documents_range(start, end)
 
         result = result if result else {}
         return SensitiveDocumentsIndexSchema().dump_data(result)
 
+    def sensitive_documents_page_view(self,
+                                      risk,
+                                      after=None,
+                                      limit=100,
+                                      descending=False,
+                                      relation=None,
+                                      keyword=None,
+                                      person=None):
+        """
+        Streams a page of GDPR results as
+        {"results": [...], "next": <cursor or null>}. Results are stored as
+        JSON, so they are written out as they are read from the database.
+        """
+        limit = _page_limit(limit)
+        results = self.controllers.sensitive_documents_page(
+            risk,
+            after=after,
+            limit=limit,
+            descending=descending,
+            relation=relation,
+            keyword=keyword,
+            person=person
+        )
+
+        def generate():
+            yield '{"results": ['
+            last_id = None
+            count = 0
+            for document_id, data in results:
+                if count:
+                    yield ','
+                yield json.dumps(data)
+                last_id = document_id
+                count += 1
+            next_cursor = last_id if count == limit else None
+            yield '], "next": {}}}'.format(json.dumps(next_cursor))
+
+        return streamed_response(generate())
+
     def get_metadata_view(self, u_document_id):
         res = self.controllers.get_metadata(u_document_id)
         return success_response(res)
@@ -190,6 +241,7 @@ class View:
         self.controllers.remove_gdpr_documents(
             document_ids
         )
+        self.controllers.set_gdpr_documents_included(document_ids, False)
 
         return success_response()
 
@@ -1,4 +1,4 @@
-from flask import jsonify
+from flask import jsonify, Response, stream_with_context
 
 
 def success_response(result=None):
@@ -6,3 +6,11 @@ def success_response(result=None):
         return 'ok', 200
 
     return jsonify(result), 200
+
+
+def streamed_response(chunks, mimetype='application/json'):
+    """
+    Streams the response while chunks are generated, so large results are
+    never held in memory as a whole.
+    """
+    return Response(stream_with_context(chunks), mimetype=mimetype), 200
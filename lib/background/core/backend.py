@@ -1,9 +1,10 @@
 import re
-from io import BytesIO
 import tempfile
+from contextlib import contextmanager
 from typing import NamedTuple, Sequence
-import pickle
 from collections import defaultdict
+from functools import lru_cache
+from itertools import chain
 
 import phonenumbers
 
@@ -41,34 +42,63 @@ from archii.database.models.gdpr_document import (
 MAX_ENTITY_LENGTH = 150
 
 
-def _find_regex_entities(doc):
+@lru_cache(maxsize=None)
+def _named_entity_id(label):
+    """
+    Named entities are static rows keyed by their label, so the lookup is
+    cached for the lifetime of the worker instead of once per document.
+    """
+    return db.get_by_id(db.NamedEntity, label).id
+
+
+class MentionAccumulator(object):
+    """
+    Collects the mentions found in a single document and writes them
+    with one bulk insert instead of one ORM insert per match.
+    """
+
+    def __init__(self, document):
+        self.document_id = document.id
+        self.mentions = []
+
+    def add(self, entity_label, start, end, occurrence):
+        self.mentions.append({
+            'document': self.document_id,
+            'entity': _named_entity_id(entity_label),
+            'validated': False,
+            'start': start,
+            'end': end,
+            'occurrence': occurrence
+        })
+
+    def flush(self):
+        if self.mentions:
+            db.bulk_add(Mention, self.mentions)
+        count = len(self.mentions)
+        self.mentions = []
+        return count
+
+
+def _find_regex_entities(doc, mentions: MentionAccumulator):
     cpr_pattern = r'\b[0-3][0-9]{5} ?-? ?([0-9]{4}|[xX]{4})\b'
-    cpr_entity = db.get_by_id(db.NamedEntity, 'CPR_NUMBER')
 
     for match in re.finditer(cpr_pattern, doc.text):
         match_str = match.group()
         match_val = match_str.replace('-', "").replace(" ", "")
         if validate_cpr(match_val):
-            db.add(
-                Mention,
-                document=doc,
-                entity=cpr_entity,
-                validated=False,
-                start=match.start(),
-                end=match.end(),
-                occurrence=match_str
+            mentions.add(
+                'CPR_NUMBER',
+                match.start(),
+                match.end(),
+                match_str
             )
 
-    phone_entity = db.get_by_id(db.NamedEntity, 'PHONE_NUMBER')
     for match in phonenumbers.PhoneNumberMatcher(doc.text, 'DK'):
-        db.add(
-            Mention,
-            document=doc,
-            entity=phone_entity,
-            validated=False,
-            start=match.start,
-            end=match.end,
-            occurrence=match.raw_string
+        mentions.add(
+            'PHONE_NUMBER',
+            match.start,
+            match.end,
+            match.raw_string
         )
 
 
@@ -77,6 +107,7 @@ def ner(document_id):
         return document.text[start:end]
 
     doc = db.get_by_id(Document, document_id)
+    mentions = MentionAccumulator(doc)
     # entities = nlp.english.ner(doc.text)
     # TODO(Stahl) fix memory leak
     entities = []
@@ -86,54 +117,64 @@ def ner(document_id):
             Log().warning("Detected abnormally large entity and skipping it",
                           document_id=document_id)
             continue
-        entity = db.get_by_id(db.NamedEntity, span.label_)
-        db.add(Mention,
-               document=doc,
-               entity=entity,
-               validated=False,
-               start=span.start_char,
-               end=span.end_char,
-               occurrence=get_occurrence(doc, span.start_char, span.end_char))
-    _find_regex_entities(doc)
+        mentions.add(span.label_,
+                     span.start_char,
+                     span.end_char,
+                     get_occurrence(doc, span.start_char, span.end_char))
+    _find_regex_entities(doc, mentions)
+    mention_count = mentions.flush()
     Log().info(
         "Finished NER processing.",
         document=document_id,
-        count=len(entities)
+        count=len(entities),
+        mentions=mention_count
     )
 
 
-def _get_file_to_tmp_path(
+# Remote files larger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+@contextmanager
+def _open_document_file(
         storage_manager,
         document_meta: DocumentMeta
 ):
-    stream = BytesIO()
-    success, stream = storage_manager.get_file(
-        document_meta.storage_key,
-        stream
-    )
-
-    if not success:
-        raise Exception('Failed to read file from the storage manager.')
-
-    ext = '.' + document_meta.ext
-
-    fd, file_path = tempfile.mkstemp(suffix=ext)
-
-    with(open(fd, 'wb')) as file:
-        file.write(stream.read())
-        file.close()
+    """
+    Opens the document as a File without keeping extra copies of it around.
+    Local and mounted storage hands over an open buffer directly. Remote
+    storage is streamed in chunks into a spooled temporary file, which is
+    removed when the context exits.
+    """
+    if storage_manager.is_local:
+        buffer = storage_manager.open_file(document_meta.storage_key)
+    else:
+        buffer = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_SIZE,
+            suffix='.' + document_meta.ext
+        )
+        success = storage_manager.stream_file(
+            document_meta.storage_key,
+            buffer
+        )
+        if not success:
+            buffer.close()
+            raise Exception('Failed to read file from the storage manager.')
+        buffer.seek(0)
 
-    return file_path
+    try:
+        yield File(buffer, extension=document_meta.ext)
+    finally:
+        buffer.close()
 
 
 def read_document(document_meta: DocumentMeta):
     """
     This task should:
-        1. Read a document from a file
+        1. Stream a document from the storage manager
         2. Extract the text by normal means or OCR
         3. Connect the extracted document to the database entry with
         information about who entered the document into the system
-    :param path: The local path of the file
     :param document_meta: Current processing document
     for the user/document relation
     :return: 'doc_exists': a bool indicating whether the document was
@@ -145,30 +186,18 @@ def read_document(document_meta: DocumentMeta):
     storage_manager = StorageFactory.get_storage_manager(
         data_location, mode='datasource')
 
-    tmp_path = _get_file_to_tmp_path(storage_manager, document_meta)
-
-    f = File(tmp_path)
-
     doc_exists = doc = user_doc = None
     company = data_location.user.company
-    with db.session:
+    with _open_document_file(storage_manager, document_meta) as f, \
+            db.session:
         try:
-            doc = db.get_company_doc_with_identifiers(
-                company.id,
-                f.md5(),
-                document_meta.name
-            )
+            doc = db.get_company_doc_with_md5(company.id, f.md5())
             doc_exists = doc is not None
 
             if not doc_exists:
                 doc = _create_document(f, document_meta)
 
-            user_doc = _create_user_doc(document_meta, doc)
-            doc.user_documents.add(user_doc)
-
-            if document_meta.tracked_folder is not None:
-                _add_tracked_folders(document_meta.tracked_folder, user_doc)
-            scan.user_documents.add(user_doc)
+            user_doc = _link_user_doc(document_meta, doc, scan)
             db.commit()
 
         except Exception as e:
@@ -179,6 +208,35 @@ def read_document(document_meta: DocumentMeta):
     return doc_exists, doc.id, user_doc.id
 
 
+def link_known_document(document_meta: DocumentMeta, document_id):
+    """
+    Connects a document we already have to the user who entered it again,
+    without reading the file. Used when the content hash of the file is
+    already in the company's dedup index.
+    :return: the user document id
+    """
+    scan = db.get_by_id(Scan, document_meta.scan_id)
+    with db.session:
+        try:
+            doc = db.get_by_id(Document, document_id)
+            user_doc = _link_user_doc(document_meta, doc, scan)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise e
+    return user_doc.id
+
+
+def _link_user_doc(document_meta: DocumentMeta, doc, scan):
+    user_doc = _create_user_doc(document_meta, doc)
+    doc.user_documents.add(user_doc)
+
+    if document_meta.tracked_folder is not None:
+        _add_tracked_folders(document_meta.tracked_folder, user_doc)
+    scan.user_documents.add(user_doc)
+    return user_doc
+
+
 def _add_tracked_folders(tracked_folder_id, user_doc):
     tracked_folder = db.get_by_id(
         TrackedFolder,
@@ -198,32 +256,56 @@ def _create_user_doc(document_meta: DocumentMeta, doc):
     return user_doc
 
 
-def _create_document(file: File, document_meta):
-    text = file.extract()
-    language, prob = get_lang(text)
+class Extraction(NamedTuple):
+    text: str
+    language: str
+    probability: float
+
+
+def _extract_text(file: File) -> Extraction:
+    """
+    Detects the language on a cheap sample (e.g. the first page) and then
+    runs the full extraction once with that language, so scanned documents
+    in a non-default language are only OCR'ed once. If the sample is empty
+    or too short to tell the language, e.g. a blank cover page, the language
+    is detected on the full extraction instead.
+    """
+    min_confidence = config.get().meta_config.min_lang_confidence
     allowed_languages = [lang.code for lang in db.get_languages()]
+    sample = file.extract(sample=True)
+    language, prob = get_lang(sample) if sample else (None, 0.0)
+    text = None
+    if prob < min_confidence:
+        text = file.extract()
+        if not text:
+            raise ExtractionFailed("No text on this document")
+        language, prob = get_lang(text)
     if language not in allowed_languages:
         raise ExtractionFailed("Language not allowed")
-    if prob < config.get().meta_config.min_lang_confidence:
+    if prob < min_confidence:
         raise ExtractionFailed("Language confidence too low!")
-    if not text:
-        raise ExtractionFailed("No text on this document")
-    # if not default language, do another extract
-    if language != allowed_languages[0]:
+
+    # The full extraction above used the default language
+    if text is None or language != allowed_languages[0]:
         file.lang = language
         text = file.extract()
-        if not text:
-            raise ExtractionFailed("No text on this document")
+    if not text:
+        raise ExtractionFailed("No text on this document")
+    return Extraction(text, language, prob)
+
+
+def _create_document(file: File, document_meta):
+    extraction = _extract_text(file)
 
     doc = Document()
     doc.name = document_meta.name
-    doc.text = text
-    doc.language = db.get_language_by_code(language)
+    doc.text = extraction.text
+    doc.language = db.get_language_by_code(extraction.language)
     doc.md5 = file.md5()
     doc.extension = file.extension
     doc.size = file.size
     doc.last_modified = int(file.st_mtime)
-    doc.language_probability = prob
+    doc.language_probability = extraction.probability
     return doc
 
 
@@ -254,7 +336,7 @@ class ClassifyTaskResult(NamedTuple):
         )
 
 
-def classify(document_id, user_doc_id, cache=None):
+def _get_classifiable_document(document_id):
     doc = db.get_by_id(Document, document_id)
 
     if not doc:
@@ -263,24 +345,77 @@ def classify(document_id, user_doc_id, cache=None):
 
     if not doc.text:
         raise ValueError("No text on document")
+    return doc
+
 
-    if doc.is_validated:
-        validated = doc.validated_classes
-        return ClassifyTaskResult.make(validated, doc.md5)
+def classify(document_id, user_doc_id, cache=None):
+    return classify_documents([document_id], [user_doc_id], cache=cache)[0]
+
+
+def classify_documents(document_ids, user_doc_ids, cache=None):
+    """
+    Classifies a batch of documents with one pipeline run per language,
+    so the feature extraction and every classifier in the hierarchy run
+    once per batch instead of once per document.
+    :return: a ClassifyTaskResult for each document, in the given order
+    """
+    docs = [_get_classifiable_document(document_id)
+            for document_id in document_ids]
 
     default_language = db.get_default_language()
-    language = doc.language or default_language
-    user_doc = db.get_by_id(db.UserDocument, user_doc_id)
-    pipeline = Pipeline(language)
+    by_language = defaultdict(list)
+    for doc in docs:
+        if not doc.is_validated:
+            by_language[doc.language or default_language].append(doc)
+
+    for language, language_docs in by_language.items():
+        pipeline = Pipeline(language)
+        pipeline.classify(language_docs,
+                          titles=[doc.name for doc in language_docs],
+                          cache=cache)
+
+    results = []
+    for doc, user_doc_id in zip(docs, user_doc_ids):
+        if doc.is_validated:
+            results.append(
+                ClassifyTaskResult.make(doc.validated_classes, doc.md5)
+            )
+            continue
+        user_doc = db.get_by_id(db.UserDocument, user_doc_id)
+        latest_tracked_folder = user_doc.get_latest_tracked_folder()
+        if latest_tracked_folder and latest_tracked_folder.access_groups:
+            doc.assign_groups(latest_tracked_folder.access_groups)
+        results.append(ClassifyTaskResult.make(doc.classes, doc.md5))
+    return results
+
 
-    pipeline.classify(doc, titles=doc.name, cache=cache)
-    latest_tracked_folder = user_doc.get_latest_tracked_folder()
-    if latest_tracked_folder and latest_tracked_folder.access_groups:
-        doc.assign_groups(latest_tracked_folder.access_groups)
-    return ClassifyTaskResult.make(doc.classes, doc.md5)
+def update_models(language_id):
+    """
+    Folds a bounded batch of newly validated documents into the
+    classifiers of the language.
+    :return: the number of documents the models were updated with
+    """
+    language = db.get_by_id(db.Language, language_id)
+    batch_size = config.get().ml_config.online_update_batch_size
+    count = Pipeline(language).update(batch_size)
+    Log().info('Updated models with validated documents',
+               language=language.code,
+               count=count)
+    return count
 
 
-def merge_sensitive_documents(company_id, query_result_list):
+def merge_sensitive_documents(company_id, query_result_list,
+                              document_ids=None):
+    """
+    Merges the GDPR query results into high risk and risk documents and
+    saves them. query_result_list can be a generator, e.g.
+    elasticsearch_queries.run_concurrently, in which case results are
+    merged as the queries complete. Incremental sweeps pass the
+    document_ids of their scope, and only the stored results of those
+    documents are replaced.
+    """
+    # The queries can run for the whole Elasticsearch sweep, so no session
+    # is held open while their results are consumed
     with database.session:
         company = db.get_by_id(Company, company_id)
         cpr_documents = db.get_documents_with_cpr_numbers(company)
@@ -290,61 +425,81 @@ def merge_sensitive_documents(company_id, query_result_list):
 
         phone_documents = {doc.id for doc in phone_documents if doc.is_fresh}
         cpr_documents = {doc.id for doc in cpr_documents if doc.is_fresh}
+        if document_ids is not None:
+            phone_documents &= document_ids
+            cpr_documents &= document_ids
 
-        high_risk_documents = defaultdict(
-            lambda: HighRiskDocument()
-        )
-        risk_documents = defaultdict(lambda: RiskDocument())
+    # Elasticsearch ids are strings. Results outside the scope of an
+    # incremental sweep are dropped, as their stored results are kept.
+    scope = (None if document_ids is None
+             else {str(document_id) for document_id in document_ids})
+
+    def in_scope(result_):
+        return scope is None or str(result_.doc_id) in scope
 
-        def process_high_risk_result(result_):
+    high_risk_documents = defaultdict(
+        lambda: HighRiskDocument()
+    )
+    risk_documents = defaultdict(lambda: RiskDocument())
+
+    def process_high_risk_result(result_):
+        if not in_scope(result_):
+            return
+        document_: HighRiskDocument = high_risk_documents[result_.doc_id]
+        document_.process(result_)
+
+    def process_risk_result(result_):
+        if not in_scope(result_):
+            return
+        if result_.doc_id in cpr_documents:
             document_: HighRiskDocument = high_risk_documents[result_.doc_id]
-            document_.process(result_)
-
-        def process_risk_result(result_):
-            if result_.doc_id in cpr_documents:
-                document_: HighRiskDocument = high_risk_documents[result_.doc_id]
-            else:
-                document_: RiskDocument = risk_documents[result_.doc_id]
-            document_.process(result_)
-
-        def process_common_name_risk_result(result_):
-            if result_.doc_id in cpr_documents:
-                document_: HighRiskDocument = high_risk_documents[result_.doc_id]
-            else:
-                document_: RiskDocument = risk_documents[result_.doc_id]
-            document_.process_common_name_result(result_)
-
-        def process_common_name_high_risk_result(result_):
+        else:
+            document_: RiskDocument = risk_documents[result_.doc_id]
+        document_.process(result_)
+
+    def process_common_name_risk_result(result_):
+        if not in_scope(result_):
+            return
+        if result_.doc_id in cpr_documents:
             document_: HighRiskDocument = high_risk_documents[result_.doc_id]
-            document_.process_common_name_result(result_)
-
-        def process_gdpr_query_result(query_result_):
-            for result in query_result_.high_risk_results:
-                process_high_risk_result(result)
-            for result in query_result_.partial_high_risk_results:
-                process_high_risk_result(result)
-
-            for result in query_result.risk_results:
-                process_risk_result(result)
-            for result in query_result.partial_risk_results:
-                process_risk_result(result)
-
-        def process_common_names_query_result(query_result_):
-            for result in query_result_.high_risk_results:
-                process_common_name_high_risk_result(result)
-            for result in query_result_.risk_results:
-                process_common_name_risk_result(result)
-
-        for query_result in query_result_list:
-            if isinstance(query_result, GDPRPersonQueryResult):
-                process_gdpr_query_result(query_result)
-            elif isinstance(query_result, CommonNameQueryResult):
-                process_common_names_query_result(query_result)
-            else:
-                raise ValueError(
-                    f'Unknown query result type: {type(query_result)}'
-                )
+        else:
+            document_: RiskDocument = risk_documents[result_.doc_id]
+        document_.process_common_name_result(result_)
+
+    def process_common_name_high_risk_result(result_):
+        if not in_scope(result_):
+            return
+        document_: HighRiskDocument = high_risk_documents[result_.doc_id]
+        document_.process_common_name_result(result_)
+
+    def process_gdpr_query_result(query_result_):
+        for result in query_result_.high_risk_results:
+            process_high_risk_result(result)
+        for result in query_result_.partial_high_risk_results:
+            process_high_risk_result(result)
+
+        for result in query_result.risk_results:
+            process_risk_result(result)
+        for result in query_result.partial_risk_results:
+            process_risk_result(result)
+
+    def process_common_names_query_result(query_result_):
+        for result in query_result_.high_risk_results:
+            process_common_name_high_risk_result(result)
+        for result in query_result_.risk_results:
+            process_common_name_risk_result(result)
+
+    for query_result in query_result_list:
+        if isinstance(query_result, GDPRPersonQueryResult):
+            process_gdpr_query_result(query_result)
+        elif isinstance(query_result, CommonNameQueryResult):
+            process_common_names_query_result(query_result)
+        else:
+            raise ValueError(
+                f'Unknown query result type: {type(query_result)}'
+            )
 
+    with database.session:
         for doc_id in cpr_documents:
             document: HighRiskDocument = high_risk_documents[doc_id]
             document.process_cpr_doc(doc_id)
@@ -362,33 +517,50 @@ def merge_sensitive_documents(company_id, query_result_list):
     risk_documents = list(risk_documents.values())
 
     with database.session:
-        delete_company_gdpr_results(company.id)
-        save_gdpr_results(company.id, high_risk_documents, risk_documents)
+        delete_company_gdpr_results(company_id, document_ids=document_ids)
+        save_gdpr_results(company_id, high_risk_documents, risk_documents)
 
     Log().debug('Results saved. Finished processing GDPR.')
     return high_risk_documents, risk_documents
 
 
-def _create_result_if_fresh(company, document: RiskDocument, orm_type):
-    db_document = db.get_by_id(db.Document, document.meta['id'])
-    if db_document.is_fresh:
-        orm_type(
-            company=company,
-            data=pickle.dumps(document)
-        )
+def _document_id(document: RiskDocument) -> int:
+    # Ids of search results are Elasticsearch ids, i.e. strings
+    return int(document.meta['id'])
+
+
+def _result_row(company_id: int, document: RiskDocument):
+    """
+    A GDPR result as plain columns. The facets are stored in their own
+    columns so results can be filtered and paged in the database, and the
+    document itself as JSON instead of a pickle.
+    """
+    return {
+        'company': company_id,
+        'document_id': _document_id(document),
+        'relations': sorted(document.relations),
+        'keywords': sorted(document.keywords),
+        'names': sorted(document.names),
+        'data': document.to_dict()
+    }
 
 
 def save_gdpr_results(company_id: int,
                       high_risk_documents: Sequence[HighRiskDocument],
                       risk_documents: Sequence[RiskDocument]):
-    company = database.get_by_id(Company, company_id)
-
-    for high_risk_document in high_risk_documents:
-        _create_result_if_fresh(
-            company, high_risk_document, HighRiskResult
-        )
-
-    for risk_document in risk_documents:
-        _create_result_if_fresh(
-            company, risk_document, LowRiskResult
-        )
+    document_ids = [_document_id(document) for document
+                    in chain(high_risk_documents, risk_documents)]
+    if not document_ids:
+        return
+    fresh_ids = set(db.get_fresh_document_ids(document_ids))
+
+    high_risk_rows = [_result_row(company_id, document)
+                      for document in high_risk_documents
+                      if _document_id(document) in fresh_ids]
+    if high_risk_rows:
+        db.bulk_add(HighRiskResult, high_risk_rows)
+    risk_rows = [_result_row(company_id, document)
+                 for document in risk_documents
+                 if _document_id(document) in fresh_ids]
+    if risk_rows:
+        db.bulk_add(LowRiskResult, risk_rows)
@@ -1,4 +1,5 @@
 from celery import chord
+from celery_batches import Batches
 
 
 @celery.task(name='process_document',
@@ -9,6 +10,7 @@ def process(self, document_meta,
             user_id=None, parent_task_id=None):
     """
     This task defines the main flow for document processing:
+        0. If the content hash is already known, just add user document
         1. Extract the text from the document and insert into db
         1a. If in DB, just add user document
         2. In parallel execute:
@@ -39,6 +41,41 @@ def process(self, document_meta,
             company=company.name)
 
     tasks = []
+    # Task 0 - files with known content are linked without being read
+    if document_meta.content_md5 is not None:
+        try:
+            known_document = db.get_company_doc_with_md5(
+                company.id,
+                document_meta.content_md5
+            )
+            user_doc_id = None
+            if known_document is not None:
+                user_doc_id = link_known_document(document_meta,
+                                                  known_document.id)
+        except Exception as e:
+            error_data = {"error": str(e)}
+            after_process.delay(scan_id,
+                                error_data,
+                                False,
+                                user_id=user_id)
+            Log().exception('Linking known document failed',
+                            exc_info=e)
+            return
+        if user_doc_id is not None:
+            data = {'document_id': user_doc_id}
+            after_process.delay(scan_id, data, True, user_id=user_id)
+            return data
+
+    if document_meta.storage_key is None:
+        error_data = {"error": "Known document is no longer available"}
+        after_process.delay(scan_id,
+                            error_data,
+                            False,
+                            user_id=user_id)
+        Log().warning('Skipped download of a document that no longer exists',
+                      md5=document_meta.content_md5)
+        return
+
     # Task 1 - read_document and create it for the DB
     try:
         doc_exists, document_id, user_doc_id \
@@ -57,7 +94,9 @@ def process(self, document_meta,
 
     # Building all tasks after read_document #
     if not doc_exists:
-        tasks.append(classify_task.s(document_id, user_doc_id, user_id=user_id))
+        tasks.append(classify_batch_task.s(document_id,
+                                           user_doc_id,
+                                           user_id=user_id))
         tasks.append(ner_task.s(document_id, user_id=user_id))
         tasks.append(store_document_task.s(document_meta.storage_key,
                                            document_id,
@@ -168,6 +207,69 @@ def classify_task(self, document_id, user_doc_id, user_id=None):
     return classify(document_id, user_doc_id, cache=self.cache)
 
 
+class ClassifierCacheBatchTask(Batches, ClassifierCacheTask):
+    pass
+
+
+@celery.task(name='classify_documents',
+             bind=True,
+             base=ClassifierCacheBatchTask,
+             flush_every=config.get().task_config.classify_batch_size,
+             flush_interval=config.get().task_config.classify_batch_interval)
+@db.session
+def classify_batch_task(self, requests):
+    """
+    Gathers classify requests until flush_every documents are queued or
+    flush_interval seconds have passed, and classifies them as one batch.
+    Takes the same arguments as classify_task, so it can be used in the
+    process chord. If the batch fails, the documents are classified one by
+    one so a single bad document does not fail the others.
+    """
+    document_ids = [request.args[0] for request in requests]
+    user_doc_ids = [request.args[1] for request in requests]
+    try:
+        results = classify_documents(document_ids,
+                                     user_doc_ids,
+                                     cache=self.cache)
+    except Exception as e:
+        Log().exception('Batch classification failed, '
+                        'classifying documents one by one',
+                        exc_info=e,
+                        count=len(requests))
+        db.rollback()
+        results = None
+
+    for i, request in enumerate(requests):
+        if results is not None:
+            result = results[i]
+        else:
+            try:
+                result = classify(document_ids[i],
+                                  user_doc_ids[i],
+                                  cache=self.cache)
+            except Exception as e:
+                self.backend.mark_as_failure(request.id, e, request=request)
+                continue
+        self.backend.mark_as_done(request.id, result, request=request)
+
+
+@celery.task(name='update_models',
+             bind=True,
+             base=TaskLogger)
+@db.session
+def update_models_task(self, language_id):
+    """
+    Updates the classifiers of a language with newly validated documents,
+    one bounded batch at a time. Sent after users correct classifications.
+    The task requeues itself while a full batch was applied, so a large
+    backlog of validations is spread over several tasks.
+    """
+    count = update_models(language_id)
+    if count == config.get().ml_config.online_update_batch_size:
+        update_models_task.delay(language_id)
+    return count
+
+
 @celery.task(name='store_document',
              bind=True,
              base=TaskLogger,
@@ -183,3 +285,14 @@ def store_document_task(
     store_document(file_storage_key, document_id, data_location_id)
 
     return {'document_id': document_id}
+
+
+@celery.task(name='set_documents_included',
+             bind=True,
+             base=TaskLogger)
+def set_documents_included_task(self, company_id, document_ids, included):
+    """
+    Updates the indexed included field of documents that were included in
+    or excluded from the GDPR search, outside the API request.
+    """
+    set_documents_included(company_id, document_ids, included)
@@ -1,5 +1,15 @@
 import re as regex
-from typing import NamedTuple, List, Sequence, Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import NamedTuple, List, Sequence, Any, Callable, Iterable
+
+
+# Prefix of the named person clauses. Keyword clauses are named by their
+# keyword, so both can be told apart in matched_queries.
+PERSON_QUERY_PREFIX = '__person__:'
+# Partial matches only fetch highlighted fragments of the document text
+HIGHLIGHT_FRAGMENT_SIZE = 100
+HIGHLIGHT_FRAGMENTS = 5
 
 
 def _clean_name(name):
@@ -71,91 +81,353 @@ def _high_risk_keywords_query(high_risk_keywords):
              should=queries)
 
 
-def _get_match_range(person: 'GDPRPerson', hit) -> tuple:
+_NAME_PART_SEPARATOR = regex.compile(r"[ \-]")
+
+
+class _NameMatcher(object):
+    """
+    Matches any part of a person's cleaned name. Compiled once per person
+    and sweep instead of once per hit.
+    """
+
+    def __init__(self, person: 'GDPRPerson'):
+        self.name = person.name
+        name_parts = _NAME_PART_SEPARATOR.split(_clean_name(person.name))
+        with_word_boundaries = [r"\b({})\b".format(regex.escape(name))
+                                for name in name_parts]
+        self.pattern = regex.compile('|'.join(with_word_boundaries),
+                                     regex.IGNORECASE)
+
+    def match_range(self, hit, hit_text: '_HitText') -> tuple:
+        """
+        Given a hit, determines the range in name for which a match was
+        found in either hit's highlighted text fragments, text or name
+        property. The fragments only cover the best matches of the whole
+        batch of people, so if they miss the person's name, the hit's full
+        text is searched before its name.
+        """
+        fragments = hit.meta.highlight.text if 'highlight' in hit.meta else []
+        match = None
+        for fragment in fragments:
+            match = self.pattern.search(fragment)
+            if match is not None:
+                break
+        if match is None:
+            match = self.pattern.search(hit_text.get())
+        if match is None:
+            match = self.pattern.search(hit.name)
+        if match is None:
+            raise ValueError('No part of the name was found in the hit')
+        # get first matched group
+        matched_name_part = next(g for g in match.groups() if g is not None)
+        start_index = self.name.lower().find(matched_name_part.lower())
+        end_index = start_index + len(matched_name_part)
+        return start_index, end_index
+
+
+class _HitText(object):
     """
-    Given a name and a hit, determines the range in name for which a match
-    was found in either hit's text or name property.
+    The full text of a hit, fetched the first time the highlighted
+    fragments are not enough and then shared by every person matching it.
     """
-    cleaned = _clean_name(person.name)
-    name_parts = regex.compile(r"[ \-]").split(cleaned)
-    with_word_boundaries = [r"\b({})\b".format(name)
-                            for name in name_parts]
-    name_pattern = '|'.join(with_word_boundaries)
-    match = regex.search(name_pattern, hit.text, regex.IGNORECASE)
-    if match is None:
-        match = regex.search(name_pattern, hit.name, regex.IGNORECASE)
-    # get first matched group
-    matched_name_part = next(g for g in match.groups() if g is not None)
-    start_index = person.name.lower().find(matched_name_part.lower())
-    end_index = start_index + len(matched_name_part)
-    return start_index, end_index
+
+    def __init__(self, hit):
+        self.hit = hit
+        self._text = None
+
+    def get(self) -> str:
+        if self._text is None:
+            client = config.get().search_config.client
+            response = Search().using(client).index(
+                self.hit.meta.index
+            ).filter(
+                Ids(values=[self.hit.meta.id])
+            ).source(['text']).execute()
+            self._text = response.hits[0].text if response.hits else ''
+        return self._text
 
 
 def _language_query(language):
     return MatchPhrase(language=language.code)
 
 
-def _make_included_ids_query(company):
-    return Ids(values=company.included_document_ids)
+# Documents updated per update-by-query request
+INCLUDED_UPDATE_CHUNK_SIZE = 1000
 
 
-@curry
-@time
-def _high_risk_query(people: List[GDPRPerson],
-                     company: Company,
-                     exact: bool) -> Sequence[Any]:
+def set_documents_included(company_id, document_ids, included: bool):
+    """
+    Sets the indexed included field of the company's documents. Must be
+    called when documents are included or excluded, so the GDPR queries can
+    filter on the field instead of sending every included id.
+    """
+    client = config.get().search_config.client
+    document_ids = [str(document_id) for document_id in document_ids]
+    for i in range(0, len(document_ids), INCLUDED_UPDATE_CHUNK_SIZE):
+        chunk = document_ids[i:i + INCLUDED_UPDATE_CHUNK_SIZE]
+        UpdateByQuery(
+            using=client,
+            index=str(company_id)
+        ).filter(
+            Ids(values=chunk)
+        ).script(
+            source='ctx._source.included = params.included',
+            params={'included': included}
+        ).params(
+            conflicts='proceed'
+        ).execute()
+
+
+def sync_included_ids(company):
+    """
+    Reconciles the indexed included field with the database, updating only
+    the documents whose state differs. Called once per sweep as a backstop
+    for inclusion changes made without set_documents_included.
+    """
     client = config.get().search_config.client
+    flagged = {
+        hit.meta.id for hit in Search().using(client).index(
+            str(company.id)
+        ).filter(_make_included_ids_query()).source(False).scan()
+    }
+    included = {str(document_id)
+                for document_id in company.included_document_ids}
+    if included - flagged:
+        set_documents_included(company.id, included - flagged, True)
+    if flagged - included:
+        set_documents_included(company.id, flagged - included, False)
+    if included != flagged:
+        client.indices.refresh(index=str(company.id))
+
+
+def _make_included_ids_query():
+    # Constant-size, no matter how many documents the company has
+    return Term(included=True)
+
+
+def _people_query(name_queries, offset):
+    """
+    One query matching any of the people, with a named clause per person so
+    hits can be attributed from matched_queries.
+    """
+    named_queries = [
+        Q('bool',
+          should=[name_query],
+          _name='{}{}'.format(PERSON_QUERY_PREFIX, offset + i))
+        for i, name_query in enumerate(name_queries)
+    ]
+    return Q('bool', should=named_queries, minimum_should_match=1)
+
+
+def _split_matched_queries(matched_queries):
+    """
+    Splits matched_queries into the matched keywords and the indices of the
+    matched people.
+    """
+    keywords = []
+    people = []
+    for name in matched_queries:
+        if name.startswith(PERSON_QUERY_PREFIX):
+            people.append(int(name[len(PERSON_QUERY_PREFIX):]))
+        else:
+            keywords.append(name)
+    return keywords, people
+
+
+def _match_range(person, matcher, hit, hit_text):
+    """
+    The match range of a partial match, or None if it could not be found.
+    """
+    try:
+        return matcher.match_range(hit, hit_text)
+    except Exception:
+        Log().exception(
+            'Error while creating search result',
+            document_id=hit.meta.id,
+            name=person.name
+        )
+        return None
+
+
+def _make_high_risk_result(person, match_range, keyword, hit):
+    if match_range is None:
+        return HighRiskSearchResult(
+            doc_id=hit.meta.id,
+            gdpr_name=person.name,
+            keyword=keyword,
+            relation=person.relation
+        )
+    return HighRiskPartialSearchResult(
+        doc_id=hit.meta.id,
+        gdpr_name=person.name,
+        keyword=keyword,
+        match_range=match_range,
+        relation=person.relation
+    )
+
+
+def find_people_document_ids(people: List[GDPRPerson], company: Company):
+    """
+    The ids of the included documents that partially match any of the
+    people. Used to scope incremental sweeps when names are added.
+    """
+    search_config = config.get().search_config
+    name_queries = _make_name_queries(people, exact=False)
+    document_ids = set()
+    for offset in range(0, len(name_queries), search_config.people_per_query):
+        batch = name_queries[offset:offset + search_config.people_per_query]
+        search = Search().using(
+            search_config.client
+        ).index(str(company.id)).query().filter(
+            _make_included_ids_query()
+        ).filter(
+            Q('bool', should=batch, minimum_should_match=1)
+        ).source(False)
+        document_ids.update(int(hit.meta.id) for hit in search.scan())
+    return document_ids
+
+
+def run_concurrently(queries: Iterable[Callable[[], Any]]):
+    """
+    Runs the queries on a thread pool, at most
+    search_config.max_concurrent_queries at a time, and yields their results
+    as they complete. The queries share search_config.client, whose
+    connection pool should be at least as large as the concurrency cap.
+    The sweep passes this generator to merge_sensitive_documents, so results
+    are merged as they arrive. Queries that have not started yet are
+    cancelled when one fails or the generator is closed.
+    """
+    max_workers = config.get().search_config.max_concurrent_queries
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(query) for query in queries]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # When a query fails or the consumer stops early, the queued queries
+        # are dropped instead of waited for
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _project(search, people_query, exact):
+    """
+    Requests only the fields each result type needs. Exact matches only use
+    the id and matched_queries. Partial matches also need the name and the
+    fragments of the text where the people's names were found, never the
+    full text.
+    """
+    if exact:
+        return search.source(False)
+    return search.source(['name']).highlight(
+        'text',
+        fragment_size=HIGHLIGHT_FRAGMENT_SIZE,
+        number_of_fragments=HIGHLIGHT_FRAGMENTS,
+        highlight_query=people_query.to_dict()
+    )
+
+
+def _high_risk_batch_query(client,
+                           index,
+                           filters,
+                           people_with_queries,
+                           offset,
+                           exact):
+    search_config = config.get().search_config
+    batch = people_with_queries[offset:offset + search_config.people_per_query]
+    people_query = _people_query(
+        [name_query for _, name_query, _ in batch], offset
+    )
+    search = Search().using(client).index(index).query()
+    for query in filters:
+        search = search.filter(query)
+    search = search.filter(people_query)
+    search = _project(search, people_query, exact)
+
+    results = []
+    response = search.scan()
+    for hit in response:
+        keywords, matched_people = _split_matched_queries(
+            hit.meta.matched_queries
+        )
+        hit_text = _HitText(hit)
+        for person_index in matched_people:
+            person, _, matcher = people_with_queries[person_index]
+            match_range = None
+            if matcher is not None:
+                # Once per person and hit, not once per matched keyword
+                match_range = _match_range(person, matcher, hit, hit_text)
+                if match_range is None:
+                    continue
+            for keyword in keywords:
+                results.append(
+                    _make_high_risk_result(person, match_range, keyword, hit)
+                )
+    return results
+
+
+def high_risk_batch_queries(people: List[GDPRPerson],
+                            company: Company,
+                            exact: bool,
+                            document_ids=None) -> List[Callable[[], list]]:
+    """
+    The scrolls of a high risk search as callables, one per language and
+    batch of people_per_query people. The sweep submits the callables of
+    all its searches to a single run_concurrently pool, so the concurrency
+    cap holds for the whole sweep. Incremental sweeps pass the document_ids
+    of their scope to only search those documents.
+    """
+    search_config = config.get().search_config
+    client = search_config.client
     name_queries = _make_name_queries(people, exact)
-    included_ids_query = _make_included_ids_query(company)
+    # Exact matches need no match range
+    if exact:
+        matchers = [None] * len(people)
+    else:
+        matchers = [_NameMatcher(person) for person in people]
+    people_with_queries = list(zip(people, name_queries, matchers))
+    included_ids_query = _make_included_ids_query()
     with database.session:
         languages = get_languages()
 
-    results = []
+    queries = []
     for language in languages:
-        high_risk_keywords = (config
-                              .get()
-                              .search_config.high_risk_keywords[language.code])
-        keyword_query = _high_risk_keywords_query(high_risk_keywords)
-        language_query = _language_query(language)
-        for person, name_query in zip(people, name_queries):
-            search = Search().using(client).index(str(company.id)).query()
-
-            search = search.filter(
-                included_ids_query
-            ).filter(
-                language_query
-            ).filter(
-                keyword_query
-            ).filter(
-                name_query
-            )
-            response = search.scan()
-            for hit in response:
-                for keyword in hit.meta.matched_queries:
-                    if exact:
-                        result = HighRiskSearchResult(
-                            doc_id=hit.meta.id,
-                            gdpr_name=person.name,
-                            keyword=keyword,
-                            relation=person.relation
-                        )
-                        results.append(result)
-                    else:
-                        try:
-                            result = HighRiskPartialSearchResult(
-                                doc_id=hit.meta.id,
-                                gdpr_name=person.name,
-                                keyword=keyword,
-                                match_range=_get_match_range(person, hit),
-                                relation=person.relation
-                            )
-                            results.append(result)
-                        except Exception:
-                            Log().exception(
-                                'Error while creating search result',
-                                document_id=hit.meta.id,
-                                name=person.name,
-                                keyword=keyword
-                            )
-    return results
+        high_risk_keywords = search_config.high_risk_keywords[language.code]
+        filters = [
+            included_ids_query,
+            _language_query(language),
+            _high_risk_keywords_query(high_risk_keywords)
+        ]
+        if document_ids is not None:
+            filters.append(Ids(values=list(document_ids)))
+        for offset in range(0, len(people_with_queries),
+                            search_config.people_per_query):
+            queries.append(partial(_high_risk_batch_query,
+                                   client,
+                                   str(company.id),
+                                   filters,
+                                   people_with_queries,
+                                   offset,
+                                   exact))
+    return queries
 
+
+@curry
+@time
+def _high_risk_query(people: List[GDPRPerson],
+                     company: Company,
+                     exact: bool,
+                     document_ids=None) -> Sequence[Any]:
+    """
+    Searches for documents with both a person's name and a high risk
+    keyword. The people are searched in batches of people_per_query with
+    one scroll per batch and language, instead of one per person. The
+    scrolls run one after the other, as this query is itself run on the
+    sweep's run_concurrently pool.
+    """
+    results = []
+    for query in high_risk_batch_queries(people, company, exact,
+                                         document_ids):
+        results.extend(query())
+    return results
@@ -0,0 +1,95 @@
+from datetime import datetime
+from typing import NamedTuple, Optional, Set, List
+
+import archii.database as db
+from archii.background.core.elasticsearch_queries import (
+    find_people_document_ids,
+    sync_included_ids
+)
+from archii.database.models import Company, GDPRPerson
+from archii.database.queries.gdpr_documents import (
+    get_company_gdpr_result_document_ids
+)
+
+
+# Version of the stored GDPR results. Results of an older version, e.g.
+# pickled rows without the facet columns, are replaced by a full sweep.
+RESULT_FORMAT = 2
+# Incremental scopes are sent as an id list with every search request.
+# Larger scopes are searched with a full sweep instead.
+MAX_SCOPE_SIZE = 10000
+
+
+def _person_key(person: GDPRPerson):
+    # A person whose relation changed has to be searched again as well
+    return person.name, str(person.relation)
+
+
+class SweepScope(NamedTuple):
+    """
+    The documents a GDPR sweep has to search again. document_ids is None
+    for a full sweep of the company.
+    """
+    document_ids: Optional[Set[int]]
+    started: datetime
+
+    @property
+    def is_full(self):
+        return self.document_ids is None
+
+    @property
+    def is_empty(self):
+        return self.document_ids is not None and not self.document_ids
+
+
+def plan_sweep(company: Company, people: List[GDPRPerson]) -> SweepScope:
+    """
+    Works out which documents have to be searched again since the last
+    sweep:
+        1. Documents added since the last sweep
+        2. If people were removed, the documents that have results
+        3. If people were added, the documents mentioning the added names
+        4. Documents with results that are no longer included
+    People are compared by name and relation. The scope is searched for all
+    people, and its results replace the stored results of these documents
+    only. The first sweep of a company, the first sweep after the result
+    format changed and sweeps of more than MAX_SCOPE_SIZE documents are full
+    sweeps.
+    """
+    started = datetime.now()
+    sync_included_ids(company)
+    if (company.gdpr_swept_at is None
+            or company.gdpr_result_format != RESULT_FORMAT):
+        return SweepScope(None, started)
+
+    swept_people = {tuple(key) for key in company.gdpr_swept_people}
+    keys = {_person_key(person) for person in people}
+    added_people = [person for person in people
+                    if _person_key(person) not in swept_people]
+    removed_people = swept_people - keys
+
+    result_ids = set(get_company_gdpr_result_document_ids(company.id))
+    document_ids = set(db.get_company_document_ids_since(
+        company, company.gdpr_swept_at
+    ))
+    if removed_people:
+        document_ids |= result_ids
+    if added_people:
+        document_ids |= set(find_people_document_ids(added_people, company))
+    document_ids |= result_ids - set(company.included_document_ids)
+    if len(document_ids) > MAX_SCOPE_SIZE:
+        return SweepScope(None, started)
+    return SweepScope(document_ids, started)
+
+
+def finish_sweep(company: Company,
+                 people: List[GDPRPerson],
+                 scope: SweepScope):
+    """
+    Records the sweep, so the next one only searches what changed after
+    it started.
+    """
+    company.gdpr_swept_at = scope.started
+    company.gdpr_swept_people = [list(_person_key(person))
+                                 for person in people]
+    company.gdpr_result_format = RESULT_FORMAT
@@ -10,3 +10,4 @@ class DocumentMeta(NamedTuple):
     scan_id: int
     ext: str
     tracked_folder: int = None
+    content_md5: str = None
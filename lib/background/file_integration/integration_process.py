@@ -15,6 +15,7 @@ class IntegrationProcess(object):
     data_location = None
     storage_manager = None
     fresh_uuids = None
+    company_id = None
 
     # Count how many documents were sent to be stored.
     # It's used in the 'store' method.
@@ -56,6 +57,7 @@ class IntegrationProcess(object):
         self.uuid_map = defaultdict(list)
         [self.uuid_map[user_doc.uuid].append(user_doc.id)
          for user_doc in self.data_location.user_documents]
+        self.company_id = self.data_location.user.company.id
 
     def authenticate(self):
         self.strategy.authenticate()
@@ -126,6 +128,20 @@ class IntegrationProcess(object):
             Log().info('Adding file to fresh uuids', uuid=file_uuid)
             self.fresh_uuids.append((file_uuid, tracked_folder))
             return
+        # Known content only costs a metadata lookup,
+        # the document is linked without downloading it
+        content_md5 = self.strategy.get_content_md5(meta_datum)
+        if self.is_known_content(content_md5):
+            Log().info('Skipping download of known content',
+                       uuid=file_uuid,
+                       md5=content_md5)
+            self.init_process_document(
+                self.strategy.get_file_meta_data(meta_datum),
+                tracked_folder=tracked_folder,
+                content_md5=content_md5,
+                downloaded=False
+            )
+            return
         try:
             downloaded_files = self.strategy.get_files_as_bytes(meta_datum)
             for downloaded_file in downloaded_files:
@@ -135,7 +151,8 @@ class IntegrationProcess(object):
                 )
                 self.init_process_document(
                     metadata,
-                    tracked_folder=tracked_folder
+                    tracked_folder=tracked_folder,
+                    content_md5=hashlib.md5(file_bytes).hexdigest()
                 )
         except Exception as e:
             Log().exception("Error happened while "
@@ -143,6 +160,19 @@ class IntegrationProcess(object):
                             exc_info=e)
             raise e
 
+    def is_known_content(self, content_md5):
+        """
+        Whether the company already has a document with this content. One
+        lookup on the indexed md5 column per file, so nothing is loaded
+        up front for large companies.
+        """
+        if content_md5 is None:
+            return False
+        with db.session:
+            document = db.get_company_doc_with_md5(self.company_id,
+                                                   content_md5)
+            return document is not None
+
     def is_relevant(self, file):
         extension = self.strategy.try_get_file_extension(file)
         # TODO(Magnus, Sune, Felipe) add logging statements
@@ -165,19 +195,24 @@ class IntegrationProcess(object):
 
     def init_process_document(self,
                               file_meta_data: FileMetaData,
-                              tracked_folder=None):
+                              tracked_folder=None,
+                              content_md5=None,
+                              downloaded=True):
         identifier_hash = self.get_identifier_hash(file_meta_data.iuuid)
         date: str = file_meta_data.created.strftime("%Y-%m-%d %H:%M:%S")
         tracked_folder_id = tracked_folder['id'] if tracked_folder else None
+        # Files that were not downloaded have nothing in the storage
+        storage_key = identifier_hash if downloaded else None
 
         document_meta = DocumentMeta(identifier_hash,
                                      file_meta_data.path,
-                                     identifier_hash,
+                                     storage_key,
                                      date,
                                      file_meta_data.name,
                                      self.scan_id,
                                      file_meta_data.ext,
-                                     tracked_folder=tracked_folder_id)
+                                     tracked_folder=tracked_folder_id,
+                                     content_md5=content_md5)
         Log().info(
             "Processing Document",
             original_path=file_meta_data.path,
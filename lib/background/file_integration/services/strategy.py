@@ -82,6 +82,17 @@ class IntegrationStrategy(object):
     def get_file_size_mb(self, file) -> float:
         raise NotImplementedError
 
+    def get_content_md5(self, file) -> Optional[str]:
+        """
+        The md5 of the file content if the integration exposes it in its
+        metadata, which lets us skip downloading files we already have.
+        """
+        return None
+
+    def get_file_meta_data(self, file) -> FileMetaData:
+        # Only needed by strategies that implement get_content_md5
+        raise NotImplementedError
+
     def close(self):
         self.connected = False
 
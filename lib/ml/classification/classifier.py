@@ -1,7 +1,8 @@
 import os
 from datetime import datetime
 
-from sklearn.externals import joblib
+from archii.ml import model_store
+
 
 class Prediction:
     @property
@@ -20,23 +21,106 @@ class Prediction:
 
 
 class Classifier(Persistable):
+    # Bumped by online updates, which the ClassifierCache picks up
+    version = 0
+    # Watermark of the validations applied online
+    updated_at = None
+    updated_document_id = 0
+
     @staticmethod
-    def load(entity):
+    def load(entity, writable=False):
         raise NotImplementedError
 
     def __init__(self, feature_extractor, model, uuid, path):
         super().__init__(path)
         self.feature_extractor = feature_extractor
+        # The exact fit the classifier is trained with. Extractors fitted
+        # before they were versioned have no such path and are embedded.
+        self.feature_extractor_path = feature_extractor.versioned_path
+        self.feature_extractor_version = feature_extractor.version
         self.model = model
         self.uuid = uuid
         self.fitted_on_all_data = False
 
+    def __getstate__(self):
+        # The feature extractor is persisted once per fit and language,
+        # not embedded in every classifier. Classifiers persisted before
+        # the model store have no path and keep embedding their copy.
+        state = self.__dict__.copy()
+        if state.get('feature_extractor_path') is not None:
+            del state['feature_extractor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'feature_extractor' in state:
+            return
+        feature_extractor = model_store.load_feature_extractor(
+            self.feature_extractor_path
+        )
+        if feature_extractor.version != self.feature_extractor_version:
+            raise ValueError(
+                'The feature extractor at {} is not the one this '
+                'classifier was trained with.'.format(
+                    self.feature_extractor_path
+                )
+            )
+        self.feature_extractor = feature_extractor
+
+    def persist(self):
+        model_store.dump(self, self.path)
+
     def fit(self, documents, labels, titles=None):
         vectors = self.feature_extractor.transform(documents, titles)
         self.model.fit(vectors, labels)
 
+    def fit_batches(self, batches, classes):
+        """
+        Trains out-of-core on an iterable of (documents, labels, titles)
+        batches. Requires a model with partial_fit, e.g. sgd_log.
+        :param classes: all labels, since a batch may not contain all of them
+        """
+        for documents, labels, titles in batches:
+            vectors = self.feature_extractor.transform(documents, titles)
+            self.model.partial_fit(vectors, labels, classes=classes)
+
+    @property
+    def supports_partial_fit(self):
+        return hasattr(self.model, 'partial_fit')
+
+    def partial_fit_vectors(self, vectors, labels):
+        """
+        Updates a fitted model with new vectors. Labels the model has not
+        been trained on are skipped, since they need a full retrain.
+        """
+        known = set(self.model.classes_)
+        rows = [i for i, label in enumerate(labels) if label in known]
+        if rows:
+            self.model.partial_fit(vectors[rows],
+                                   [labels[i] for i in rows],
+                                   classes=self.model.classes_)
+        self.version += 1
+
+    def last_update(self):
+        """
+        When the model last learned from validations. Models that were
+        never updated online are as fresh as their file.
+        """
+        if self.updated_at is not None:
+            return self.updated_at
+        # Local time, like the timestamps of the classifications
+        return datetime.fromtimestamp(os.path.getmtime(self.path))
+
     def predict(self, docs, titles=None):
         vectors = self.feature_extractor.transform(docs, titles)
+        return self.predict_vectors(vectors)
+
+    def predict_vectors(self, vectors):
+        """
+        Predicts from vectors made by the feature extractor of the language.
+        All classifiers of a language share the same feature extractor, so
+        the vectors can be reused across the whole category hierarchy.
+        """
         labels = self.model.predict(vectors)
         try:
             classes = self.model.classes_
@@ -62,9 +146,9 @@ class CategoryClassifier(Classifier):
         super().__init__(feature_extractor, model, uuid, path)
 
     @staticmethod
-    def load(category):
+    def load(category, writable=False):
         path = Path.classifier(category)
-        return joblib.load(path)
+        return model_store.load(path, writable=writable)
 
     @staticmethod
     def exists(category):
@@ -74,9 +158,9 @@ class CategoryClassifier(Classifier):
 
 class RootClassifier(Classifier):
     @staticmethod
-    def load(language):
+    def load(language, writable=False):
         path = Path.root_classifier(language)
-        return joblib.load(path)
+        return model_store.load(path, writable=writable)
 
     def __init__(self, language):
         feature_extractor = FeatureExtractor.load(language)
@@ -93,11 +177,18 @@ class RootClassifier(Classifier):
 
 class ClassifierCache:
     def __init__(self):
-        self.root_classifier_cache = Cache(
-            RootClassifier,
-            key_function=lambda l: l.index
+        cache_bytes = config.get().ml_config.classifier_cache_mb * 1024 * 1024
+        # The configured budget is split between the two caches
+        max_bytes = cache_bytes // 2
+        self.root_classifier_cache = model_store.ModelCache(
+            RootClassifier.load,
+            key_function=lambda l: l.index,
+            path_function=Path.root_classifier,
+            max_bytes=max_bytes
         )
-        self.category_classifier_cache = Cache(
-            CategoryClassifier,
-            key_function=lambda c: c.index
+        self.category_classifier_cache = model_store.ModelCache(
+            CategoryClassifier.load,
+            key_function=lambda c: c.index,
+            path_function=Path.classifier,
+            max_bytes=max_bytes
         )
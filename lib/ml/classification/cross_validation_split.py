@@ -1,49 +1,130 @@
+import multiprocessing
 import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 
-import pandas
+import numpy
 from sklearn.externals import joblib
 from sklearn.model_selection import StratifiedKFold, train_test_split
 
+import archii.database as db
 from archii.database import label
+from archii.ml import model_store
 from archii.ml.classification.validation_split import ValidationSplit
+from archii.ml.feature.feature_extractor import FeatureExtractor
+from archii.ml.feature.token_cache import TokenCache
 from archii.ml.path import Path
 from archii.ml.persistable import Persistable
 from archii import config
 
 
-def _filter_too_few_labels(documents, labels):
-    data = pandas.DataFrame(
-        {
-            'documents': documents,
-            'categories': labels
-        }
-    )
-    too_few = data.categories.value_counts() < config.get().ml_config.folds
-    for l in too_few[too_few].index:
-        data = data[data.categories != l]
-    return data.documents, data.categories
+class TrainingDocument(NamedTuple):
+    """
+    The plain document data needed for training, detached from the ORM so
+    fold functions do not depend on a database session.
+    """
+    id: int
+    md5: str
+    name: str
+    text: str
+    extension: str
+    label: str
+
+
+# Set in the parent process right before the fold workers are forked,
+# so the workers share the pages instead of receiving pickled copies.
+_shared_folds = None
+_shared_fold_function = None
+_shared_language = None
+
+
+# Documents loaded per query while streaming the training data of a fold
+TRAINING_CHUNK_SIZE = 1000
+
+
+def _training_document(doc):
+    return TrainingDocument(doc.id,
+                            doc.md5,
+                            doc.name,
+                            doc.text,
+                            doc.extension,
+                            label.leaf_label(doc))
+
+
+class TrainingDocuments(object):
+    """
+    Re-iterable stream of the training documents with the given ids. The
+    documents are loaded TRAINING_CHUNK_SIZE at a time, each chunk in its own
+    session, so a worker never holds more than one chunk of text, and no
+    query lists every id of the fold.
+    """
+
+    def __init__(self, document_ids):
+        self.document_ids = sorted(document_ids)
+
+    def __len__(self):
+        return len(self.document_ids)
+
+    def __iter__(self):
+        for i in range(0, len(self.document_ids), TRAINING_CHUNK_SIZE):
+            chunk = self.document_ids[i:i + TRAINING_CHUNK_SIZE]
+            with db.session:
+                documents = [
+                    _training_document(doc) for doc in
+                    db.Document.select(lambda d: d.id in chunk)
+                ]
+            yield from documents
+
+
+def _run_fold(index, result_path, token_cache_path):
+    fold = _shared_folds[index]
+    # A new extractor per fold, so the token cache is never attached to the
+    # process-wide extractor from model_store.load_feature_extractor
+    feature_extractor = FeatureExtractor(_shared_language)
+    feature_extractor.use_token_cache(TokenCache(token_cache_path))
+    result = _shared_fold_function(fold,
+                                   feature_extractor,
+                                   TrainingDocuments(fold.train_ids),
+                                   TrainingDocuments(fold.test_ids))
+    model_store.dump(result, result_path)
+    return index
+
+
+def _load_split_data(language):
+    """
+    Loads the ids and leaf labels of the validated documents with a
+    projection query, as compact arrays of ids and label codes.
+    """
+    rows = label.validated_leaf_labels(language)
+    ids = numpy.array([doc_id for doc_id, _ in rows], dtype=numpy.int64)
+    _, codes = numpy.unique([leaf for _, leaf in rows], return_inverse=True)
+    return ids, codes
+
+
+def _filter_too_few_labels(ids, codes):
+    counts = numpy.bincount(codes)
+    enough = counts[codes] >= config.get().ml_config.folds
+    return ids[enough], codes[enough]
 
 
 def _split(language, folds, sample_size=None):
-    documents = language.validated_documents
-    labels = [label.leaf_label(doc) for doc in documents]
+    ids, codes = _load_split_data(language)
     if sample_size is not None:
-        documents, _, labels, _ = train_test_split(
-            documents,
-            labels,
+        ids, _, codes, _ = train_test_split(
+            ids,
+            codes,
             test_size=1.0 - sample_size,
-            stratify=labels
+            stratify=codes
         )
-    documents, labels = _filter_too_few_labels(documents, labels)
+    ids, codes = _filter_too_few_labels(ids, codes)
     splitter = StratifiedKFold(n_splits=folds)
     validation_splits = []
-    splits = enumerate(splitter.split(documents, labels))
+    splits = enumerate(splitter.split(ids, codes))
     for split_count, (train_indices, test_indices) in splits:
-        train_docs = documents.iloc[train_indices]
-        test_docs = documents.iloc[test_indices]
         train_ids, test_ids = (
-            set(doc.id for doc in train_docs),
-            set(doc.id for doc in test_docs)
+            set(ids[train_indices].tolist()),
+            set(ids[test_indices].tolist())
         )
         validation_split = ValidationSplit(
             language,
@@ -59,15 +140,31 @@ class CrossValidationSplit(Persistable):
     @staticmethod
     def load(language):
         path = Path.cross_validation_split(language)
-        return joblib.load(path)
+        split = joblib.load(path)
+        # Splits persisted before the language was stored
+        split.language = language
+        return split
 
     def __init__(self, language, folds=5, sample_size=None):
         path = Path.cross_validation_split(language)
         super().__init__(path)
+        self.language = language
         self.folds = _split(language, folds, sample_size)
+        self.all_folds = list(self.folds)
+        # Fold results of an earlier split must never be reused for this one
+        self.split_id = uuid.uuid4().hex
         self.completed_folds = []
         self.current_fold = None
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Splits persisted before run_parallel existed
+        if 'all_folds' not in state:
+            current = [self.current_fold] if self.current_fold else []
+            self.all_folds = self.completed_folds + current + self.folds
+        if 'split_id' not in state:
+            self.split_id = uuid.uuid4().hex
+
     def __iter__(self):
         return self
 
@@ -89,6 +186,59 @@ class CrossValidationSplit(Persistable):
             self.persist()
             raise StopIteration
 
+    def _fold_result_path(self, index):
+        return '{}.{}.fold{}'.format(self.path, self.split_id, index)
+
+    def _token_cache_path(self):
+        return '{}.tokens'.format(self.path)
+
+    def run_parallel(self, fold_function, processes=None):
+        """
+        Runs the folds at the same time in a process pool, one fold per
+        core by default. fold_function(fold, feature_extractor,
+        train_documents, test_documents) is called in the worker with an
+        unfitted FeatureExtractor and TrainingDocuments streams of the fold's
+        training and test documents. The extractors of all folds share one
+        token cache, so each document is tokenized once per split instead of
+        once per fold. Each fold result is persisted on its own, so after a
+        crash only the unfinished folds are run again.
+        :return: the fold results in fold order
+        """
+        global _shared_folds, _shared_fold_function, _shared_language
+        pending = [index for index in range(len(self.all_folds))
+                   if not os.path.isfile(self._fold_result_path(index))]
+        if pending:
+            # Persists the split_id, so a resumed run finds these results
+            self.persist()
+            _shared_folds = self.all_folds
+            _shared_fold_function = fold_function
+            _shared_language = self.language
+            # Forked workers must not share the parent's database socket,
+            # each one opens its own connection
+            db.disconnect()
+            context = multiprocessing.get_context('fork')
+            try:
+                with ProcessPoolExecutor(
+                        max_workers=processes or min(len(pending),
+                                                     os.cpu_count()),
+                        mp_context=context
+                ) as executor:
+                    futures = [
+                        executor.submit(_run_fold,
+                                        index,
+                                        self._fold_result_path(index),
+                                        self._token_cache_path())
+                        for index in pending
+                    ]
+                    for future in futures:
+                        future.result()
+            finally:
+                _shared_folds = None
+                _shared_fold_function = None
+                _shared_language = None
+        return [joblib.load(self._fold_result_path(index))
+                for index in range(len(self.all_folds))]
+
     @staticmethod
     def exists(language):
         path = Path.cross_validation_split(language)
@@ -1,17 +1,88 @@
 # -*- coding: utf-8 -*-
+import numpy
+from scipy.stats import reciprocal
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.calibration import CalibratedClassifierCV
 from sklearn.feature_selection import SelectKBest, chi2
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import GridSearchCV
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import (
+    GridSearchCV,
+    RandomizedSearchCV,
+    train_test_split
+)
 from sklearn.pipeline import Pipeline
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 
 SCORING = "f1_micro"
 C_VALUES = [1e-2, 1e-1, 1, 10, 1e2]
 ALPHA_VALUES = [1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1]
 GAMMA_VALUES = [0.1, 1, 10, 1e2, 1e3]
+C_DISTRIBUTION = reciprocal(1e-2, 1e2)
+GAMMA_DISTRIBUTION = reciprocal(0.1, 1e3)
+N_ITER = 10
+N_JOBS = -1
+SGD_ALPHA = 1e-5
+SGD_MAX_ITER = 20
+CALIBRATION_SIZE = 0.2
+CALIBRATION_FOLDS = 3
 VERBOSE = 0
 
 
+class CalibratedSearch(BaseEstimator, ClassifierMixin):
+    """
+    Runs a hyperparameter search without probability estimates and
+    calibrates the best estimator once at the end on a held-out part of
+    the data, instead of fitting Platt scaling for every grid point. If a
+    class is too small to hold out, the best estimator is calibrated with
+    CALIBRATION_FOLDS-fold cross-validation instead.
+    """
+
+    def __init__(self, search, calibration_size=CALIBRATION_SIZE):
+        self.search = search
+        self.calibration_size = calibration_size
+
+    def _can_hold_out(self, y):
+        # Every class needs a sample on both sides of the stratified split
+        smallest = numpy.unique(y, return_counts=True)[1].min()
+        return (smallest * self.calibration_size >= 1
+                and smallest * (1 - self.calibration_size) >= 1)
+
+    def fit(self, X, y):
+        search = clone(self.search)
+        if self._can_hold_out(y):
+            X_fit, X_calibrate, y_fit, y_calibrate = train_test_split(
+                X,
+                y,
+                test_size=self.calibration_size,
+                stratify=y
+            )
+            search.fit(X_fit, y_fit)
+            self.calibrated_ = CalibratedClassifierCV(
+                search.best_estimator_,
+                cv="prefit"
+            )
+            self.calibrated_.fit(X_calibrate, y_calibrate)
+        else:
+            # Classes too small to hold out a calibration set are calibrated
+            # with cross-validation on all of the data instead
+            search.fit(X, y)
+            self.calibrated_ = CalibratedClassifierCV(
+                clone(search.best_estimator_),
+                cv=CALIBRATION_FOLDS
+            )
+            self.calibrated_.fit(X, y)
+        self.best_estimator_ = search.best_estimator_
+        self.best_params_ = search.best_params_
+        self.classes_ = self.calibrated_.classes_
+        return self
+
+    def predict(self, X):
+        return self.calibrated_.predict(X)
+
+    def predict_proba(self, X):
+        return self.calibrated_.predict_proba(X)
+
+
 def get(model_name):
     models = {
         "linear_svc_simple":
@@ -67,6 +138,94 @@ def get(model_name):
                 "clf__gamma": GAMMA_VALUES,
                 "clf__probability": [True]
             }
+        ),
+
+        "linear_svc_calibrated": CalibratedSearch(
+            GridSearchCV(
+                estimator=LinearSVC(verbose=VERBOSE),
+                param_grid={"C": C_VALUES},
+                scoring=SCORING,
+                n_jobs=N_JOBS
+            )
+        ),
+
+        "linear_svc_randomized": CalibratedSearch(
+            RandomizedSearchCV(
+                estimator=SVC(kernel="linear", verbose=VERBOSE),
+                param_distributions={"C": C_DISTRIBUTION},
+                n_iter=N_ITER,
+                scoring=SCORING,
+                n_jobs=N_JOBS
+            )
+        ),
+
+        "rbf_svc_randomized": CalibratedSearch(
+            RandomizedSearchCV(
+                estimator=SVC(kernel="rbf", verbose=VERBOSE),
+                param_distributions={
+                    "C": C_DISTRIBUTION,
+                    "gamma": GAMMA_DISTRIBUTION
+                },
+                n_iter=N_ITER,
+                scoring=SCORING,
+                n_jobs=N_JOBS
+            )
+        ),
+
+        "dimred_nonlinear_randomized": CalibratedSearch(
+            RandomizedSearchCV(
+                estimator=Pipeline(
+                    [
+                        ("reduce_dim", SelectKBest(chi2)),
+                        ("clf", SVC(kernel="rbf"))
+                    ]
+                ),
+                param_distributions={
+                    "reduce_dim__k": [10, 20, 100, 500],
+                    "clf__C": C_DISTRIBUTION,
+                    "clf__gamma": GAMMA_DISTRIBUTION
+                },
+                n_iter=N_ITER,
+                scoring=SCORING,
+                n_jobs=N_JOBS
+            )
+        ),
+
+        # Linear-time models for large corpora. sgd_log keeps partial_fit,
+        # so it can be trained out-of-core with Classifier.fit_batches.
+        "sgd_log": SGDClassifier(
+            loss="log",
+            alpha=SGD_ALPHA,
+            max_iter=SGD_MAX_ITER,
+            tol=None,
+            n_jobs=N_JOBS
+        ),
+
+        "sgd_log_search": GridSearchCV(
+            estimator=SGDClassifier(
+                loss="log",
+                max_iter=SGD_MAX_ITER,
+                tol=None
+            ),
+            param_grid={"alpha": ALPHA_VALUES},
+            scoring=SCORING,
+            n_jobs=N_JOBS
+        ),
+
+        "sgd_hinge_calibrated": CalibratedClassifierCV(
+            SGDClassifier(
+                loss="hinge",
+                alpha=SGD_ALPHA,
+                max_iter=SGD_MAX_ITER,
+                tol=None
+            ),
+            cv=3
+        ),
+
+        "logistic_regression_saga": LogisticRegression(
+            solver="saga",
+            multi_class="multinomial",
+            n_jobs=N_JOBS
         )
     }
     try:
@@ -1,3 +1,4 @@
+from collections import defaultdict
 
 
 def create_classification(prediction, category):
@@ -10,31 +11,160 @@ def create_classification(prediction, category):
     return classification
 
 
+def _category_path(category):
+    """
+    The categories from the root of the hierarchy down to category.
+    """
+    path = [category]
+    while path[0].parent_category:
+        path.insert(0, path[0].parent_category)
+    return path
+
+
+def _validation_time(document):
+    return max(classification.timestamp
+               for classification in document.validated_classes)
+
+
+def _validated_documents_since(language, since, since_id, limit):
+    """
+    Up to limit documents of the language validated after the watermark,
+    ordered by ascending (validation time, document id). Documents sharing
+    a validation time are told apart by id, so a batch that ends among them
+    resumes right after its last document.
+    """
+    return database.Document.select(
+        lambda d: d.language == language
+        and (max(c.timestamp for c in d.classes if c.validated) > since
+             or (max(c.timestamp for c in d.classes if c.validated) == since
+                 and d.id > since_id))
+    ).order_by(
+        lambda d: (max(c.timestamp for c in d.classes if c.validated), d.id)
+    )[:limit]
+
+
 class Pipeline:
     def __init__(self, language):
         self.language = language
 
+    def _root_classifier(self, cache=None):
+        if cache:
+            return cache.root_classifier_cache.load(self.language)
+        return RootClassifier.load(self.language)
+
+    @staticmethod
+    def _category_classifier(category, cache=None):
+        if cache:
+            return cache.category_classifier_cache.load(category)
+        return CategoryClassifier.load(category)
+
+    @staticmethod
+    def _add_classifications(predictions, documents, rows):
+        """
+        Adds the predicted classifications to the documents and groups the
+        vector rows of the documents by the predicted category for the next
+        level.
+        """
+        by_category = defaultdict(list)
+        for prediction, row in zip(predictions, rows):
+            category = database.Category[prediction.label]
+            classification = create_classification(prediction, category)
+            documents[row].classes.add(classification)
+            by_category[category].append(row)
+        return by_category
+
     @database.session
     def classify(self, documents, cache=None, titles=None):
+        """
+        Classifies the documents level by level in the category hierarchy.
+        The documents are vectorized once and grouped by their predicted
+        category, so each classifier makes one predict call per level for
+        the whole batch.
+        """
         if not type(documents) == list:
             documents = [documents]
         if not type(titles) == list:
             titles = [titles]
-        if cache:
-            root_classifier = cache.root_classifier_cache.load(self.language)
-        else:
-            root_classifier = RootClassifier.load(self.language)
-        root_predictions = root_classifier.predict(documents, titles)
-        for prediction, doc, title in zip(root_predictions, documents, titles):
-            category = database.Category[prediction.label]
-            classification = create_classification(prediction, category)
-            doc.classes.add(classification)
-            while CategoryClassifier.exists(category):
-                if cache:
-                    classifier = cache.category_classifier_cache.load(category)
-                else:
-                    classifier = CategoryClassifier.load(category)
-                prediction = classifier.predict([doc], [title]).pop()
-                category = database.Category[prediction.label]
-                classification = create_classification(prediction, category)
-                doc.classes.add(classification)
+        root_classifier = self._root_classifier(cache)
+        vectors = root_classifier.feature_extractor.transform(
+            documents, titles
+        ).tocsr()
+        root_predictions = root_classifier.predict_vectors(vectors)
+        by_category = self._add_classifications(
+            root_predictions, documents, range(len(documents))
+        )
+        while by_category:
+            next_level = defaultdict(list)
+            for category, rows in by_category.items():
+                if not CategoryClassifier.exists(category):
+                    continue
+                classifier = self._category_classifier(category, cache)
+                predictions = classifier.predict_vectors(vectors[rows])
+                classified = self._add_classifications(
+                    predictions, documents, rows
+                )
+                for next_category, next_rows in classified.items():
+                    next_level[next_category].extend(next_rows)
+            by_category = next_level
+
+    def _update_category_classifiers(self, vectors, paths):
+        """
+        Updates each category classifier with the documents whose validated
+        category path passes through its category.
+        """
+        rows_by_category = defaultdict(list)
+        labels_by_category = defaultdict(list)
+        for row, path in enumerate(paths):
+            for parent, child in zip(path, path[1:]):
+                rows_by_category[parent].append(row)
+                labels_by_category[parent].append(child.index)
+
+        for category, rows in rows_by_category.items():
+            if not CategoryClassifier.exists(category):
+                continue
+            classifier = CategoryClassifier.load(category, writable=True)
+            if not classifier.supports_partial_fit:
+                continue
+            classifier.partial_fit_vectors(vectors[rows],
+                                           labels_by_category[category])
+            classifier.persist()
+
+    @database.session
+    def update(self, batch_size):
+        """
+        Folds up to batch_size documents validated since the last update
+        into the root and category classifiers with partial_fit. Models
+        without partial_fit only change on a full retrain.
+        :return: the number of documents the models were updated with
+        """
+        root_classifier = RootClassifier.load(self.language, writable=True)
+        if not root_classifier.supports_partial_fit:
+            Log().info('Root classifier does not support online updates',
+                       language=self.language.code)
+            return 0
+
+        documents = _validated_documents_since(
+            self.language,
+            root_classifier.last_update(),
+            root_classifier.updated_document_id,
+            batch_size
+        )
+        if not documents:
+            return 0
+
+        vectors = root_classifier.feature_extractor.transform(
+            documents, [doc.name for doc in documents]
+        ).tocsr()
+        paths = [_category_path(database.Category[label.leaf_label(doc)])
+                 for doc in documents]
+        self._update_category_classifiers(vectors, paths)
+
+        # The root classifier is persisted last, since it holds the
+        # watermark of the validations that have been applied
+        root_classifier.partial_fit_vectors(
+            vectors, [path[0].index for path in paths]
+        )
+        root_classifier.updated_at = _validation_time(documents[-1])
+        root_classifier.updated_document_id = documents[-1].id
+        root_classifier.persist()
+        return len(documents)
@@ -1,14 +1,24 @@
+from functools import lru_cache
+
 from archii import config
 
 
-def extension(document):
+@lru_cache(maxsize=1)
+def _extension_codes():
     meta_config = config.get().meta_config
-    if document.extension in meta_config.documents:
-        return 1
-    if document.extension in meta_config.presentations:
-        return 2
-    if document.extension in meta_config.spreadsheets:
-        return 3
-    if document.extension in meta_config.hypertext:
-        return 4
-    return 0
+    codes = {}
+    # Reversed so the first matching group wins, like the old lookup order
+    groups = [
+        (meta_config.hypertext, 4),
+        (meta_config.spreadsheets, 3),
+        (meta_config.presentations, 2),
+        (meta_config.documents, 1)
+    ]
+    for extensions, code in groups:
+        for ext in extensions:
+            codes[ext] = code
+    return codes
+
+
+def extension(document):
+    return _extension_codes().get(document.extension, 0)
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import nltk
 import numpy
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
@@ -11,10 +13,19 @@ def _tokenize(doc):
     return nltk.word_tokenize(doc)
 
 
-def _get_tagged_docs(docs):
-    for i, doc in enumerate(docs):
-        words = _tokenize(doc)
-        yield TaggedDocument(words, [i])
+class _TaggedCorpus(object):
+    """
+    Re-iterable corpus of tagged documents. build_vocab and every training
+    epoch iterate over it again, which a generator would not allow.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __iter__(self):
+        for i, doc in enumerate(self.docs):
+            words = _tokenize(doc)
+            yield TaggedDocument(words, [i])
 
 
 class Doc2VecVectorizer(TransformerMixin):
@@ -22,19 +33,28 @@ class Doc2VecVectorizer(TransformerMixin):
         self._model = Doc2Vec(*args, **kwargs)
 
     def fit(self, docs):
-        tagged_docs = _get_tagged_docs(docs)
-        self._model.build_vocab(tagged_docs)
+        corpus = _TaggedCorpus(docs)
+        self._model.build_vocab(corpus)
         self._model.train(
-            tagged_docs,
+            corpus,
             total_examples=self._model.corpus_count,
             epochs=self._model.iter
         )
         return self
 
+    def _infer(self, doc):
+        return self._model.infer_vector(_tokenize(doc))
+
     def transform(self, docs):
-        vectors = []
-        for doc in docs:
-            words = _tokenize(doc)
-            vector = self._model.infer_vector(words)
-            vectors.append(vector)
-        return numpy.array(vectors)
+        """
+        Infers the document vectors on a pool of the model's workers. The
+        inference loops release the GIL, so threads run in parallel.
+        """
+        vectors = numpy.empty(
+            (len(docs), self._model.vector_size),
+            dtype=numpy.float32
+        )
+        with ThreadPoolExecutor(max_workers=self._model.workers) as executor:
+            for i, vector in enumerate(executor.map(self._infer, docs)):
+                vectors[i] = vector
+        return vectors
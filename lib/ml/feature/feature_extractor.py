@@ -1,10 +1,18 @@
 import os
+import uuid
 
+import numpy
 from scipy import sparse
-from sklearn.externals import joblib
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import (
+    HashingVectorizer,
+    TfidfTransformer,
+    TfidfVectorizer
+)
+from sklearn.pipeline import make_pipeline
 
 from archii import config
+from archii.ml import model_store
+from archii.ml.feature.token_cache import TokenCache
 from archii.ml.path import Path
 from archii.ml.persistable import Persistable
 
@@ -24,15 +32,21 @@ def get_stop_words(lang):
 
 
 class FeatureExtractor(Persistable):
+    token_cache = None
+    # Changes every time the extractor is fitted, so classifiers can tell
+    # whether they were trained against the extractor on disk
+    version = None
+    language_code = None
 
     @staticmethod
     def load(language):
         path = Path.feature_extractor(language)
-        return joblib.load(path)
+        return model_store.load(path)
 
     def __init__(self, language):
         path = Path.feature_extractor(language)
         super().__init__(path)
+        self.language_code = language.code
         fe_config = config.get().ml_config. \
             feature_extractor_configs[language.code]
         self.ngram_range = fe_config.ngram_range
@@ -50,52 +64,116 @@ class FeatureExtractor(Persistable):
             self.vectorizer = TfidfVectorizer(stop_words=stop_words,
                                               ngram_range=fe_config.ngram_range,
                                               min_df=0.01)
+        elif fe_config.vectorizer == "hashing":
+            # No vocabulary is stored, only the IDF weights of the fixed
+            # number of hashed features, so the state loads almost instantly
+            self.vectorizer = make_pipeline(
+                HashingVectorizer(stop_words=stop_words,
+                                  ngram_range=fe_config.ngram_range,
+                                  n_features=fe_config.hashing_features,
+                                  alternate_sign=False,
+                                  norm=None),
+                TfidfTransformer()
+            )
         else:
             # Completely user-supplied vectorizer...
             self.vectorizer = fe_config.vectorizer
 
+    def __getstate__(self):
+        # The token cache is attached per process and not persisted
+        state = self.__dict__.copy()
+        state.pop('token_cache', None)
+        return state
+
+    def use_token_cache(self, token_cache: TokenCache):
+        self.token_cache = token_cache
+
+    def _token_cache_key(self, doc):
+        tokenizer = type(self.tokenizer)
+        return '{}:{}:{}.{}:{}'.format(doc.md5,
+                                       self.language_code,
+                                       tokenizer.__module__,
+                                       tokenizer.__qualname__,
+                                       self.document_cutting)
+
+    def _tokenize(self, text):
+        tokens = self.tokenizer.tokenize(text)
+        if self.document_cutting:
+            tokens = tokens[:self.document_cutting]
+        return " ".join(tokens)
+
     def _preprocess(self, docs):
-        texts = [doc.text for doc in docs]
+        if self.token_cache is None:
+            return [self._tokenize(doc.text) for doc in docs]
+
+        keys = [self._token_cache_key(doc) for doc in docs]
+        cached = self.token_cache.get_many(keys)
         result = []
-        for text in texts:
-            tokens = self.tokenizer.tokenize(text)
-            if self.document_cutting:
-                tokens = tokens[:self.document_cutting]
-            result.append(" ".join(tokens))
+        tokenized = {}
+        for doc, key in zip(docs, keys):
+            text = cached.get(key)
+            if text is None:
+                text = self._tokenize(doc.text)
+                tokenized[key] = text
+            result.append(text)
+        if tokenized:
+            self.token_cache.put_many(tokenized)
         return result
 
+    def _new_version(self):
+        self.version = uuid.uuid4().hex
+
     def fit_transform(self, docs, titles=None):
+        self._new_version()
         preprocessed_texts = self._preprocess(docs)
         tfidf_vectors = self.vectorizer.fit_transform(preprocessed_texts)
         title_vectors = self.title_vectorizer.fit_transform(titles)
-        vectors = sparse.hstack([tfidf_vectors, title_vectors])
-        vectors = self._add_custom_features(vectors, docs)
-        return vectors
+        return self._stack(tfidf_vectors, title_vectors, docs)
 
     def transform(self, docs, titles=None):
         preprocessed_texts = self._preprocess(docs)
         tfidf_vectors = self.vectorizer.transform(preprocessed_texts)
         title_vectors = self.title_vectorizer.transform(titles)
-        vectors = sparse.hstack([tfidf_vectors, title_vectors])
-        vectors = self._add_custom_features(vectors, docs)
-        return vectors
+        return self._stack(tfidf_vectors, title_vectors, docs)
 
     def fit(self, docs, titles=None):
+        self._new_version()
         preprocessed_texts = self._preprocess(docs)
         self.title_vectorizer.fit(titles)
         self.vectorizer.fit(preprocessed_texts)
 
+    @property
+    def versioned_path(self):
+        """
+        Where this fit of the extractor is kept. Classifiers load their
+        extractor from here, so refitting never changes the extractor of
+        classifiers that have not been retrained yet.
+        """
+        if self.version is None:
+            return None
+        return '{}.{}'.format(self.path, self.version)
+
+    def persist(self):
+        if self.versioned_path is not None:
+            model_store.dump(self, self.versioned_path)
+        model_store.dump(self, self.path)
+
     @staticmethod
     def exists(language):
         return os.path.isfile(Path.feature_extractor(language))
 
-    def _add_custom_features(self, vectors, docs):
-        if self.custom_features is None:
-            return vectors
-        for custom_feature in self.custom_features:
-            column = []
-            for doc in docs:
-                feature = custom_feature(doc)
-                column.append([feature])
-            vectors = sparse.hstack([vectors, column])
-        return vectors
+    def _custom_features(self, docs):
+        """
+        Computes all custom features for the batch as one dense block.
+        """
+        return numpy.array(
+            [[custom_feature(doc) for custom_feature in self.custom_features]
+             for doc in docs],
+            dtype=numpy.float64
+        )
+
+    def _stack(self, tfidf_vectors, title_vectors, docs):
+        blocks = [tfidf_vectors, title_vectors]
+        if self.custom_features:
+            blocks.append(self._custom_features(docs))
+        return sparse.hstack(blocks, format='csr')
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import zlib
+from collections import OrderedDict
+
+# Texts written per transaction
+WRITE_CHUNK_SIZE = 200
+
+
+class TokenCache(object):
+    """
+    Caches preprocessed document texts on disk, keyed by document md5 and
+    the tokenizer configuration, with a bounded in-memory LRU in front.
+    Values are stored zlib compressed in a SQLite file, which can be shared
+    by several processes.
+    """
+
+    def __init__(self, path, max_memory_items=10000):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def connection(self):
+        # SQLite connections must not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            # Readers do not block the writer of another fold, and the other
+            # way around
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens '
+                '(key TEXT PRIMARY KEY, value BLOB)'
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                found[key] = self._memory[key]
+            else:
+                missing.append(key)
+        # Stay below SQLite's limit on query parameters
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            rows = self.connection.execute(
+                'SELECT key, value FROM tokens WHERE key IN ({})'.format(
+                    ','.join('?' * len(chunk))
+                ),
+                chunk
+            )
+            for key, value in rows:
+                text = zlib.decompress(value).decode('utf-8')
+                self._remember(key, text)
+                found[key] = text
+        return found
+
+    def put_many(self, texts):
+        for key, text in texts.items():
+            self._remember(key, text)
+        items = list(texts.items())
+        # Short transactions, so other folds never wait long for the lock
+        for i in range(0, len(items), WRITE_CHUNK_SIZE):
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO tokens (key, value) VALUES (?, ?)',
+                    [(key, zlib.compress(text.encode('utf-8')))
+                     for key, text in items[i:i + WRITE_CHUNK_SIZE]]
+                )
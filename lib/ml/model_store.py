@@ -0,0 +1,108 @@
+import os
+import tempfile
+from collections import OrderedDict
+from typing import NamedTuple, Any
+
+from sklearn.externals import joblib
+
+# Feature extractors shared by all classifiers of a language in this process
+_feature_extractors = {}
+
+# Read once, since the umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def dump(obj, path):
+    """
+    Persists a model uncompressed, so its numpy arrays can be memory mapped
+    when it is loaded. The model is written to a temporary file that then
+    replaces path, since workers may have the old file memory mapped and
+    rewriting it in place would crash them.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        joblib.dump(obj, tmp_path, compress=0)
+        # mkstemp creates the file readable by its owner only, and workers
+        # may run as another user than the training job
+        os.chmod(tmp_path, 0o644 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load(path, writable=False):
+    """
+    Loads a model with its numpy arrays memory mapped read-only. Worker
+    processes loading the same file share the pages instead of each
+    keeping a private copy. Models that will be updated in place are
+    loaded writable, as private copies.
+    """
+    if writable:
+        return joblib.load(path)
+    return joblib.load(path, mmap_mode='r')
+
+
+def load_feature_extractor(path):
+    """
+    Loads the feature extractor at path once per process. It is reloaded
+    when the file on disk changes.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _feature_extractors.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, load(path))
+        _feature_extractors[path] = cached
+    return cached[1]
+
+
+class _CacheEntry(NamedTuple):
+    mtime: float
+    size: int
+    model: Any
+
+
+class ModelCache(object):
+    """
+    LRU cache of loaded models, bounded by the size of the model files on
+    disk. A model is reloaded when its file has changed since it was
+    loaded, so retrained models are picked up without restarting workers.
+    """
+
+    def __init__(self, loader, key_function, path_function, max_bytes):
+        self.loader = loader
+        self.key_function = key_function
+        self.path_function = path_function
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def load(self, entity):
+        key = self.key_function(entity)
+        path = self.path_function(entity)
+        mtime = os.path.getmtime(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry.mtime == mtime:
+            self._entries.move_to_end(key)
+            return entry.model
+        if entry is not None:
+            self._evict(key)
+
+        entry = _CacheEntry(mtime, os.path.getsize(path), self.loader(entity))
+        self._entries[key] = entry
+        self.size += entry.size
+        # Always keep the model that was just loaded
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            self._evict(next(iter(self._entries)))
+        return entry.model
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0